@@ -19,12 +19,13 @@ transform wikitext-2, wikitext-103, lambada, openwebtext dataset to mindrecord.
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 
 import argparse
+import array
 import glob
 import json
 import os
 import re
-import time
-from multiprocessing import current_process, Process
+from itertools import chain
+from multiprocessing import Pool, Process, Queue
 import numpy as np
 
 import sentencepiece as spm
@@ -32,11 +33,55 @@ import jieba
 
 from mindspore.mindrecord import FileWriter
 
-
-def chunks(lst, n):
-    """ yield n sized chunks from list"""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson parses 2-3x faster than the stdlib and both accept raw bytes
+_json_loads = orjson.loads if orjson is not None else json.loads
+# map curly double quotes to plain ones in a single pass
+_QUOTE_TRANS = str.maketrans("“”", '""')
+
+
+# literal replacements applied by clean_wikitext, fused into a single pass
+_CLEAN_MAP = {
+    "s '": "s'",  # contractions
+    " @-@ ": "-",  # number separators
+    " @,@ ": ",",
+    " @.@ ": ".",
+    " : ": ": ",  # punctuation
+    " ; ": "; ",
+    " . ": ". ",
+    " ! ": "! ",
+    " ? ": "? ",
+    " , ": ", ",
+    "= = = =": "====",  # miscellaneous
+    "= = =": "===",
+    "= =": "==",
+    " " + chr(176) + " ": chr(176),
+}
+# longest keys first so e.g. "= = = =" wins over "= ="
+_CLEAN_RE = re.compile("|".join(re.escape(k) for k in sorted(_CLEAN_MAP, key=len, reverse=True)))
+
+# pre-compiled patterns used by clean_wikitext, compiled once at import time
+_RE_NUMSEP = re.compile(r"/' [0-9]/")
+_RE_PAREN = re.compile(r"\(\s*([^\)]*?)\s*\)")
+_RE_BRACK = re.compile(r"\[\s*([^\]]*?)\s*\]")
+_RE_BRACE = re.compile(r"{\s*([^}]*?)\s*}")
+_RE_DQUOTE = re.compile(r"\"\s*([^\"]*?)\s*\"")
+_RE_SQUOTE = re.compile(r"'\s*([^']*?)\s*'")
+# blank lines in raw wikitext still carry spaces (' \n \n'); cleaning used to
+# collapse them to '\n\n' before the split, so match them directly instead
+_RE_PARA_SPLIT = re.compile(r"\n(?:[ \t]*\n)+")
+
+
+def chunk_samples(content, seq_length):
+    """pack a packed id buffer into seq_length-sized samples with a single reshape"""
+    arr = np.frombuffer(content, dtype=np.int32)  # zero-copy view of array.array('i')
+    num_tokens = (arr.size // seq_length) * seq_length
+    for row in arr[:num_tokens].reshape(-1, seq_length):
+        yield {'input_ids': row}
 
 
 def package_file(it, n):
@@ -56,115 +101,159 @@ def package_file(it, n):
 
 def clean_wikitext(string):
     """ cleaning wikitext dataset"""
-    # contractions
-    string = string.replace("s '", "s'")
-    string = re.sub(r"/' [0-9]/", r"/'[0-9]/", string)
-    # number separators
-    string = string.replace(" @-@ ", "-")
-    string = string.replace(" @,@ ", ",")
-    string = string.replace(" @.@ ", ".")
-    # punctuation
-    string = string.replace(" : ", ": ")
-    string = string.replace(" ; ", "; ")
-    string = string.replace(" . ", ". ")
-    string = string.replace(" ! ", "! ")
-    string = string.replace(" ? ", "? ")
-    string = string.replace(" , ", ", ")
+    string = _RE_NUMSEP.sub(r"/'[0-9]/", string)
+    # most literal replacements in one pass instead of ~20 full-string copies
+    string = _CLEAN_RE.sub(lambda m: _CLEAN_MAP[m.group(0)], string)
     # double brackets
-    string = re.sub(r"\(\s*([^\)]*?)\s*\)", r"(\1)", string)
-    string = re.sub(r"\[\s*([^\]]*?)\s*\]", r"[\1]", string)
-    string = re.sub(r"{\s*([^}]*?)\s*}", r"{\1}", string)
-    string = re.sub(r"\"\s*([^\"]*?)\s*\"", r'"\1"', string)
-    string = re.sub(r"'\s*([^']*?)\s*'", r"'\1'", string)
-    # miscellaneous
-    string = string.replace("= = = =", "====")
-    string = string.replace("= = =", "===")
-    string = string.replace("= =", "==")
-    string = string.replace(" " + chr(176) + " ", chr(176))
+    string = _RE_PAREN.sub(r"(\1)", string)
+    string = _RE_BRACK.sub(r"[\1]", string)
+    string = _RE_BRACE.sub(r"{\1}", string)
+    string = _RE_DQUOTE.sub(r'"\1"', string)
+    string = _RE_SQUOTE.sub(r"'\1'", string)
+    # these chain on each other's output, so they stay sequential; the strip
+    # stands in for the newline collapse at the edges of a lone paragraph,
+    # so ' N ' and ' 's' behave as they did when whole files were cleaned
     string = string.replace(" \n", "\n")
     string = string.replace("\n ", "\n")
+    string = string.strip()
     string = string.replace(" N ", " 1 ")
     string = string.replace(" 's", "'s")
     return string
 
 
+def _first_nonspace_is_equals(para):
+    """True if the first non-whitespace char is '=', without copying the text"""
+    for ch in para:
+        if ch not in ' \t\n\r':
+            return ch == '='
+    return False
+
+
+def encode_paragraphs(tokenizer, paragraphs):
+    """encode a list of paragraphs to id lists, batched when the tokenizer supports it"""
+    if hasattr(tokenizer, 'encode_batch'):
+        return tokenizer.encode_batch(paragraphs)
+    return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(para)) for para in paragraphs]
+
+
 def tokenize_openwebtext(tokenizer, iterator, seq_length, eot):
     """ tokenize openwebtext dataset"""
+    # the sub-seq_length tail of one file is carried into the next file
+    # instead of being discarded; documents stay separated by eot
+    content = array.array('i')
     for file_path in iterator:
         if os.path.getsize(file_path) == 0:
             continue
-        content = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for para in f.read().split("\n\n"):
-                if para:
-                    tokenized_text = tokenizer.tokenize(para)
-                    content += tokenizer.convert_tokens_to_ids(tokenized_text) + [
-                        eot]
-        for chunk in chunks(content, seq_length):
-            sample = {}
-            if len(chunk) == seq_length:
-                sample['input_ids'] = np.array(chunk, dtype=np.int32)
-                yield sample
+        with open(file_path, 'rb') as f:
+            text = f.read().decode('utf-8', 'replace')
+        paragraphs = [para for para in text.split("\n\n") if para]
+        ids_lists = encode_paragraphs(tokenizer, paragraphs)
+        for ids in ids_lists:
+            ids.append(eot)  # document separator
+        content.extend(chain.from_iterable(ids_lists))
+        yield from chunk_samples(content, seq_length)
+        # keep only the residual; the full chunks have been yielded
+        content = content[(len(content) // seq_length) * seq_length:]
+        del text, paragraphs
 
 
 def tokenize_wiki(tokenizer, file_path, seq_length, eot):
     """tokenize wikitext-2/wikitext-103 dataset"""
-    content = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for para in clean_wikitext(f.read()).split("\n\n"):
-            if para and para.strip().startswith('=') is False:
-                tokenized_text = tokenizer.tokenize(para)
-                content += tokenizer.convert_tokens_to_ids(tokenized_text) + [
-                    eot]
-    for chunk in chunks(content, seq_length):
-        sample = {}
-        if len(chunk) == seq_length:
-            sample['input_ids'] = np.array(chunk, dtype=np.int32)
-            yield sample
+    with open(file_path, 'rb') as f:
+        text = f.read().decode('utf-8', 'replace')
+    # split first, then clean paragraph by paragraph: cleaning the whole
+    # file at once made ~20 transient full-corpus string copies
+    paragraphs = []
+    for para in _RE_PARA_SPLIT.split(text):
+        if not para or _first_nonspace_is_equals(para):
+            continue
+        para = clean_wikitext(para)
+        if para:
+            paragraphs.append(para)
+    content = array.array('i')
+    ids_lists = encode_paragraphs(tokenizer, paragraphs)
+    for ids in ids_lists:
+        ids.append(eot)  # document separator
+    content.extend(chain.from_iterable(ids_lists))
+    yield from chunk_samples(content, seq_length)
 
 
 def tokenize_lambada(tokenizer, file_path, seq_length, eot):
     """tokenize lambada dataset"""
-    content = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f.readlines():
-            para = json.loads(line)['text'].replace(
-                "“", '"').replace("”", '"').strip().strip(".")
-            tokenized_text = tokenizer.tokenize(para)
-            content += tokenizer.convert_tokens_to_ids(tokenized_text) + [eot]
-    for chunk in chunks(content, seq_length):
-        sample = {}
-        if len(chunk) == seq_length:
-            sample['input_ids'] = np.array(chunk, dtype=np.int32)
-            yield sample
-
-
-def task_unit(iterator, tokenizer, seq_length, eot, mindrecord_filename, schema):
-    """write data into mindrecord"""
+    paragraphs = []
+    with open(file_path, 'rb') as f:
+        for line in f:  # stream the jsonl instead of loading it whole
+            paragraphs.append(_json_loads(line)['text'].translate(
+                _QUOTE_TRANS).strip().strip("."))
+    content = array.array('i')
+    ids_lists = encode_paragraphs(tokenizer, paragraphs)
+    for ids in ids_lists:
+        ids.append(eot)  # document separator
+    content.extend(chain.from_iterable(ids_lists))
+    yield from chunk_samples(content, seq_length)
+
+
+# per-worker tokenization state, filled in by init_tokenize_worker
+_tokenize_ctx = {}
+
+
+def init_tokenize_worker(tokenizer, seq_length, eot, transfer_dtype=np.int32):
+    """initialize one pool worker with the shared tokenization state"""
+    # build the trie once per worker at startup rather than during the
+    # first tokenize call when a batch of files is already waiting
+    jieba.initialize()
+    _tokenize_ctx['tokenizer'] = tokenizer
+    _tokenize_ctx['seq_length'] = seq_length
+    _tokenize_ctx['eot'] = eot
+    _tokenize_ctx['transfer_dtype'] = transfer_dtype
+
+
+def tokenize_file_batch(file_list):
+    """tokenize one batch of files inside a pool worker"""
+    samples = list(tokenize_openwebtext(_tokenize_ctx['tokenizer'], file_list,
+                                        _tokenize_ctx['seq_length'], _tokenize_ctx['eot']))
+    # mindrecord arrays can only be int32/int64, but the worker-to-writer
+    # queue is ours: ship uint16 when the vocab fits to halve the IPC bytes
+    transfer_dtype = _tokenize_ctx['transfer_dtype']
+    if transfer_dtype is not np.int32:
+        for sample in samples:
+            sample['input_ids'] = sample['input_ids'].astype(transfer_dtype)
+    return samples
+
+
+def task_unit(sample_queue, mindrecord_filename, schema, dataset_type, seq_length):
+    """write tokenized batches from sample_queue into one mindrecord shard"""
     writer = FileWriter(file_name=mindrecord_filename, shard_num=1)
-    writer.add_schema(schema, args.dataset_type)
+    writer.add_schema(schema, dataset_type)
 
-    p = current_process()
-    index = p.pid if p.pid else 0
+    index = os.getpid()
 
-    item_iter = tokenize_openwebtext(tokenizer, iterator, seq_length, eot)
-    batch_size = 1024  # size of write batch
+    batch_size = 8192  # size of write batch, ~32 MB of int32 rows at seq_length 1025
     count = 0
+    # one contiguous buffer per write batch instead of batch_size small
+    # arrays; row assignment also upcasts the uint16 transfer dtype
+    buf = np.empty((batch_size, seq_length), dtype=np.int32)
+    filled = 0
     while True:
-        data_batch = []
-        try:
-            for _ in range(batch_size):
-                data_batch.append(next(item_iter))
-                count += 1
-            writer.write_raw_data(data_batch)
-            print("Process {} transformed {} records.".format(
-                index, count))
-        except StopIteration:
-            if data_batch:
-                writer.write_raw_data(data_batch)
-                print("Process {} transformed {} records.".format(
-                    index, count))
+        samples = sample_queue.get()
+        if samples is None:  # sentinel, no more batches coming
             break
+        for sample in samples:
+            buf[filled] = sample['input_ids']
+            filled += 1
+            if filled == batch_size:
+                writer.write_raw_data([{'input_ids': row} for row in buf])
+                # fresh buffer, in case mindrecord still references the rows
+                buf = np.empty((batch_size, seq_length), dtype=np.int32)
+                filled = 0
+                count += batch_size
+                # log every 8th write so concurrent writers don't contend on stdout
+                if count % (batch_size * 8) == 0:
+                    print(f"Process {index} transformed {count} records.")
+    if filled:
+        count += filled
+        writer.write_raw_data([{'input_ids': row} for row in buf[:filled]])
+    print(f"Process {index} transformed {count} records.")
     writer.commit()
 
 
@@ -172,14 +261,22 @@ class JIEBATokenizer():
     r"""
     Jieba Tokenizer
     """
+    # web corpora repeat boilerplate paragraphs, so segmentations are cached;
+    # long paragraphs are skipped to bound the cache memory
+    seg_cache_size = 16384
+    seg_cache_max_text_len = 2048
+
     def __init__(self, model_file, max_len=None):
         self.max_len = max_len if max_len is not None else int(1e12)
         self.encoder = {}
+        # build the jieba trie eagerly instead of lazily on the first cut
+        jieba.initialize()
         self.sp = spm.SentencePieceProcessor(model_file=model_file)
 
         for i in range(self.sp.get_piece_size()):
             self.encoder[self.sp.id_to_piece(i)] = i
         self.translator = str.maketrans(" \n", "\u2582\u2583")
+        self._seg_cache = {}
 
         self.eod_id = self.encoder.get('<eod>')
         self.eot_id = self.encoder.get('<eot>')
@@ -198,13 +295,29 @@ class JIEBATokenizer():
 
     def tokenize(self, text):
         """ Tokenize a string. """
-        seg_list = [x.translate(self.translator) for x in jieba.cut(text, cut_all=False)]
+        cache = self._seg_cache
+        seg_list = cache.get(text)
+        if seg_list is not None:
+            return seg_list
+        # bind the translator once; inside the comprehension the attribute
+        # would otherwise be looked up per token
+        translator = self.translator
+        seg_list = [x.translate(translator) for x in jieba.cut(text, cut_all=False)]
+        if len(text) <= self.seg_cache_max_text_len:
+            if len(cache) >= self.seg_cache_size:
+                cache.pop(next(iter(cache)))  # FIFO eviction
+            cache[text] = seg_list
         return seg_list
 
     def convert_tokens_to_ids(self, tokens):
         new_seg = " ".join(tokens)
         return self.sp.encode(new_seg)
 
+    def encode_batch(self, texts):
+        """ Tokenize a batch of strings into id lists in one SentencePiece call. """
+        seg_lists = [" ".join(self.tokenize(text)) for text in texts]
+        return self.sp.encode(seg_lists)
+
     def convert_ids_to_tokens(self, ids):
         return self.sp.id_to_piece(ids)
 
@@ -257,6 +370,10 @@ if __name__ == '__main__':
         word_tokenizer = JIEBATokenizer(model_file=args.model_file)
 
     transforms_count = 0
+    if args.dataset_type in ('wiki', 'lambada') and args.tokenizer == 'jieba':
+        # single-process modes: let jieba fan segmentation out over all cores
+        # (fork based, so it must happen before any other multiprocessing)
+        jieba.enable_parallel(os.cpu_count())
     if args.dataset_type == 'wiki':
         wiki_writer = FileWriter(file_name=args.output_file, shard_num=args.file_partition)
         wiki_writer.add_schema(mindrecord_schema, args.dataset_type)
@@ -277,16 +394,38 @@ if __name__ == '__main__':
         SUFFIX = len(str(args.file_partition - 1))
         file_names = ["{}{}".format(args.output_file, str(x).rjust(SUFFIX, '0'))
                       for x in range(args.file_partition)]
-        file_iter = glob.iglob(args.input_glob)
+        # materialize the file list up front: a shared glob iterator duplicated
+        # into every forked child would make each child process every file
+        all_files = sorted(glob.glob(args.input_glob))
+        sample_queues = []
         process_list = {}
         for file in file_names:
-            p1 = Process(target=task_unit, args=(file_iter, word_tokenizer, args.seq_length,
-                                                 args.eot, file, mindrecord_schema))
+            # bounded so tokenizers stall instead of piling batches up in RAM
+            # when the writer falls behind
+            sample_queue = Queue(maxsize=4)
+            p1 = Process(target=task_unit, args=(sample_queue, file, mindrecord_schema,
+                                                 args.dataset_type, args.seq_length))
             p1.start()
+            sample_queues.append(sample_queue)
             process_list[file] = p1
-        for process in process_list.values():
-            while process.is_alive(): # wait child process exit
-                time.sleep(0.01)
+        # token ids below 65536 travel worker-to-writer as uint16
+        transfer_dtype = np.uint16 if word_tokenizer.vocab_size < 65536 else np.int32
+        # a pool of tokenizer workers feeds the shard writers round-robin;
+        # batching files per task amortizes the IPC cost of the results
+        try:
+            with Pool(args.num_process, initializer=init_tokenize_worker,
+                      initargs=(word_tokenizer, args.seq_length, args.eot, transfer_dtype)) as pool:
+                file_batches = package_file(iter(all_files), args.file_batch_size)
+                for i, samples in enumerate(pool.imap_unordered(tokenize_file_batch, file_batches)):
+                    sample_queues[i % args.file_partition].put(samples)
+        finally:
+            # always send the sentinels, even when a pool task raised or the
+            # run was interrupted: the writers are non-daemon processes and
+            # would otherwise block in sample_queue.get() forever
+            for sample_queue in sample_queues:
+                sample_queue.put(None)
+            for process in process_list.values():
+                process.join()
     else:
         raise ValueError(
             "Not support dataset type: {}".format(args.dataset_type))
@@ -37,6 +37,12 @@ from mindformers.modules.transformer.op_parallel_config import default_dpmp_conf
 from tests.st.test_distri_core.utils import TestData, train, transform_mlp_golden_params_to_pynative_params, \
     generate_ckpt
 
+# test data shared by generate_golden and run_parallel_mlp, built once per run
+# instead of per invocation; RandomState(2024) reproduces the exact stream
+# np.random used to draw after ms.set_seed(2024), keeping the golden losses valid
+INPUT_DATA = np.random.RandomState(2024).random_sample((3, 8, 16)).astype(np.float32)
+LABEL_DATA = np.zeros((3, 8)).astype(np.float32)
+
 class MLPNet(nn.Cell):
     """
     define a graph MLP net
@@ -92,8 +98,6 @@ def generate_golden():
     run graph mode mlp to generate golden ckpt and loss
     """
     batch_size = 1
-    dataset_size = 3
-    seq_length = 8
     hidden_size = 16
     ffn_hidden_size = 4 * hidden_size
     ms.set_context(device_target="Ascend",
@@ -106,9 +110,7 @@ def generate_golden():
     ms.set_auto_parallel_context(parallel_mode=ms.ParallelMode.STAND_ALONE)
 
     ms.set_seed(2024)
-    input_data = np.random.random((dataset_size, seq_length, hidden_size)).astype(np.float32)
-    label_data = np.zeros((dataset_size, seq_length)).astype(np.float32)
-    dataset = TestData(input_data=input_data, label_data=label_data)
+    dataset = TestData(input_data=INPUT_DATA, label_data=LABEL_DATA)
     dataset = ds.GeneratorDataset(dataset, column_names=['input_ids', 'labels'])
     dataset = dataset.batch(batch_size)
 
@@ -131,8 +133,6 @@ def run_parallel_mlp():
     run pynative mode mlp and load golden ckpt to generate pynative loss
     """
     batch_size = 1
-    dataset_size = 3
-    seq_length = 8
     hidden_size = 16
     tensor_parallel = 2
     ffn_hidden_size = 4 * hidden_size
@@ -142,9 +142,7 @@ def run_parallel_mlp():
     initialize_model_parallel(tensor_model_parallel_size=tensor_parallel)
 
     ms.set_seed(2024)
-    input_data = np.random.random((dataset_size, seq_length, hidden_size)).astype(np.float32)
-    label_data = np.zeros((dataset_size, seq_length)).astype(np.float32)
-    dataset = TestData(input_data=input_data, label_data=label_data)
+    dataset = TestData(input_data=INPUT_DATA, label_data=LABEL_DATA)
     dataset = ds.GeneratorDataset(dataset, column_names=['input_ids', 'labels'])
     dataset = dataset.batch(batch_size)
 